@@ -5,7 +5,6 @@
  * 完整接入 Moltbot 消息处理管道。
  */
 
-import { DWClient, TOPIC_ROBOT } from 'dingtalk-stream';
 import axios from 'axios';
 import type { ClawdbotPluginApi, PluginRuntime, ClawdbotConfig } from 'clawdbot/plugin-sdk';
 
@@ -113,23 +112,36 @@ function getSessionKey(
 
 // ============ Access Token 缓存 ============
 
-let accessToken: string | null = null;
-let accessTokenExpiry = 0;
+/** access_token 缓存 Map<clientId, { token, expiry }>，多账号各自缓存 */
+const accessTokenCache = new Map<string, { token: string; expiry: number }>();
+
+/** 进行中的 token 请求 Map<clientId, Promise>，过期时并发调用共享同一次请求 */
+const accessTokenPending = new Map<string, Promise<string>>();
 
 async function getAccessToken(config: any): Promise<string> {
   const now = Date.now();
-  if (accessToken && accessTokenExpiry > now + 60_000) {
-    return accessToken;
+  const cached = accessTokenCache.get(config.clientId);
+  if (cached && cached.expiry > now + 60_000) {
+    return cached.token;
   }
 
-  const response = await axios.post('https://api.dingtalk.com/v1.0/oauth2/accessToken', {
-    appKey: config.clientId,
-    appSecret: config.clientSecret,
-  });
+  let pending = accessTokenPending.get(config.clientId);
+  if (!pending) {
+    pending = (async () => {
+      const response = await axios.post('https://api.dingtalk.com/v1.0/oauth2/accessToken', {
+        appKey: config.clientId,
+        appSecret: config.clientSecret,
+      });
 
-  accessToken = response.data.accessToken;
-  accessTokenExpiry = now + (response.data.expireIn * 1000);
-  return accessToken!;
+      const token: string = response.data.accessToken;
+      accessTokenCache.set(config.clientId, { token, expiry: now + (response.data.expireIn * 1000) });
+      return token;
+    })().finally(() => {
+      accessTokenPending.delete(config.clientId);
+    });
+    accessTokenPending.set(config.clientId, pending);
+  }
+  return pending;
 }
 
 // ============ 配置工具 ============
@@ -145,20 +157,53 @@ function isConfigured(cfg: ClawdbotConfig): boolean {
 
 // ============ 钉钉图片上传 ============
 
+/** oapi access_token 缓存 Map<clientId, { token, expiry }>，token 为 null 表示获取失败（负缓存） */
+const oapiTokenCache = new Map<string, { token: string | null; expiry: number }>();
+
+/** 进行中的 oapi token 请求 Map<clientId, Promise>，并发调用共享同一次请求 */
+const oapiTokenPending = new Map<string, Promise<string | null>>();
+
+/** oapi token 获取失败后的退避时间（30秒），期间直接返回 null */
+const OAPI_TOKEN_FAILURE_TTL = 30 * 1000;
+
 async function getOapiAccessToken(config: any): Promise<string | null> {
+  const cached = oapiTokenCache.get(config.clientId);
+  if (cached && cached.expiry > Date.now()) {
+    return cached.token;
+  }
+
+  let pending = oapiTokenPending.get(config.clientId);
+  if (!pending) {
+    pending = fetchOapiAccessToken(config).finally(() => {
+      oapiTokenPending.delete(config.clientId);
+    });
+    oapiTokenPending.set(config.clientId, pending);
+  }
+  return pending;
+}
+
+async function fetchOapiAccessToken(config: any): Promise<string | null> {
+  const now = Date.now();
   try {
     const resp = await axios.get('https://oapi.dingtalk.com/gettoken', {
       params: { appkey: config.clientId, appsecret: config.clientSecret },
     });
-    if (resp.data?.errcode === 0) return resp.data.access_token;
-    return null;
-  } catch {
-    return null;
-  }
+    if (resp.data?.errcode === 0) {
+      // 提前 60 秒过期，避免使用即将失效的 token
+      oapiTokenCache.set(config.clientId, {
+        token: resp.data.access_token,
+        expiry: now + ((resp.data.expires_in || 7200) * 1000) - 60_000,
+      });
+      return resp.data.access_token;
+    }
+  } catch {}
+
+  oapiTokenCache.set(config.clientId, { token: null, expiry: now + OAPI_TOKEN_FAILURE_TTL });
+  return null;
 }
 
-function buildMediaSystemPrompt(): string {
-  return `## 钉钉图片和文件显示规则
+/** 媒体 system prompt 为静态内容，模块加载时渲染一次，每条消息直接复用 */
+const MEDIA_SYSTEM_PROMPT = `## 钉钉图片和文件显示规则
 
 你正在钉钉中与用户对话。
 
@@ -235,6 +280,9 @@ function buildMediaSystemPrompt(): string {
 **支持的文件类型**：几乎所有常见格式
 
 **重要**：文件大小不得超过 20MB，超过限制时告知用户文件过大。`;
+
+function buildMediaSystemPrompt(): string {
+  return MEDIA_SYSTEM_PROMPT;
 }
 
 // ============ 图片后处理：自动上传本地图片到钉钉 ============
@@ -437,6 +485,12 @@ const VIDEO_MARKER_PATTERN = /\[DINGTALK_VIDEO\]({.*?})\[\/DINGTALK_VIDEO\]/g;
  */
 const AUDIO_MARKER_PATTERN = /\[DINGTALK_AUDIO\]({.*?})\[\/DINGTALK_AUDIO\]/g;
 
+/**
+ * 文件/视频/音频标记合并正则：流式展示时一次扫描剥离全部标记，
+ * 避免每次更新 AI Card 都对完整内容做三遍 replace
+ */
+const MEDIA_MARKER_PATTERN = /\[DINGTALK_(FILE|VIDEO|AUDIO)\]({.*?})\[\/DINGTALK_\1\]/g;
+
 /** 视频信息接口 */
 interface VideoInfo {
   path: string;
@@ -1074,37 +1128,120 @@ async function finishAICard(
   }
 }
 
+/**
+ * AI Card 后台流式更新器（latest-wins）
+ * Gateway 读取不再等待钉钉写入：同一时刻最多一个 streaming 请求在途，
+ * 在途期间提交的内容只保留最新一份，请求结束后再发送
+ */
+function createAICardStreamer(card: AICardInstance, log?: any) {
+  let pending: string | null = null;
+  let inflight: Promise<void> | null = null;
+  let error: any = null;
+
+  const run = async (): Promise<void> => {
+    while (pending !== null && !error) {
+      const content = pending;
+      pending = null;
+      try {
+        await streamAICard(card, content, false, log);
+      } catch (err: any) {
+        error = err;
+      }
+    }
+    inflight = null;
+  };
+
+  return {
+    /** 提交最新内容；之前的更新失败时抛出该错误 */
+    push(content: string): void {
+      if (error) throw error;
+      pending = content;
+      if (!inflight) inflight = run();
+    },
+    /** 等待在途及待发送的更新完成；任一更新失败时抛出该错误 */
+    async drain(): Promise<void> {
+      if (inflight) await inflight;
+      if (error) throw error;
+    },
+  };
+}
+
 // ============ Gateway SSE Streaming ============
 
+/** SSE data 行前缀及结束标记 */
+const SSE_DATA_PREFIX = 'data: ';
+const SSE_DATA_PREFIX_LEN = SSE_DATA_PREFIX.length;
+const SSE_DONE = '[DONE]';
+
 interface GatewayOptions {
   userContent: string;
-  systemPrompts: string[];
+  systemMessages: any[];
   sessionKey: string;
   gatewayAuth?: string;  // token 或 password，都用 Bearer 格式
   log?: any;
 }
 
-async function* streamFromGateway(options: GatewayOptions): AsyncGenerator<string, void, unknown> {
-  const { userContent, systemPrompts, sessionKey, gatewayAuth, log } = options;
-  const rt = getRuntime();
-  const gatewayUrl = `http://127.0.0.1:${rt.gateway?.port || 18789}/v1/chat/completions`;
+/** Gateway chat completions 地址缓存，端口不变时直接复用 */
+let gatewayUrlPort = 0;
+let gatewayUrlCache = '';
 
-  const messages: any[] = [];
-  for (const prompt of systemPrompts) {
-    messages.push({ role: 'system', content: prompt });
+function getGatewayUrl(): string {
+  const port = getRuntime().gateway?.port || 18789;
+  if (port !== gatewayUrlPort) {
+    gatewayUrlPort = port;
+    gatewayUrlCache = `http://127.0.0.1:${port}/v1/chat/completions`;
   }
-  messages.push({ role: 'user', content: userContent });
+  return gatewayUrlCache;
+}
 
-  const headers: Record<string, string> = { 'Content-Type': 'application/json' };
-  if (gatewayAuth) {
-    headers['Authorization'] = `Bearer ${gatewayAuth}`;
+/** system 消息缓存 WeakMap<dingtalkConfig, messages>，配置重载会生成新对象，自动失效 */
+const systemMessagesCache = new WeakMap<object, any[]>();
+
+function getSystemMessages(dingtalkConfig: any): any[] {
+  let messages = systemMessagesCache.get(dingtalkConfig);
+  if (!messages) {
+    messages = [];
+    if (dingtalkConfig.enableMediaUpload !== false) {
+      // 添加图片和文件使用提示（告诉 LLM 直接输出本地路径或文件标记）
+      messages.push({ role: 'system', content: buildMediaSystemPrompt() });
+    }
+    // 自定义 system prompt
+    if (dingtalkConfig.systemPrompt) {
+      messages.push({ role: 'system', content: dingtalkConfig.systemPrompt });
+    }
+    systemMessagesCache.set(dingtalkConfig, messages);
   }
+  return messages;
+}
+
+/** Gateway 请求头缓存 Map<gatewayAuth, headers>，认证信息不变时复用同一对象 */
+const gatewayHeadersCache = new Map<string, Record<string, string>>();
+
+function getGatewayHeaders(gatewayAuth?: string): Record<string, string> {
+  const key = gatewayAuth || '';
+  let headers = gatewayHeadersCache.get(key);
+  if (!headers) {
+    // SSE 为小帧长连接，声明 identity 避免 Gateway 压缩后再逐帧解压
+    headers = { 'Content-Type': 'application/json', 'Accept-Encoding': 'identity' };
+    if (key) {
+      headers['Authorization'] = `Bearer ${key}`;
+    }
+    gatewayHeadersCache.set(key, headers);
+  }
+  return headers;
+}
+
+async function* streamFromGateway(options: GatewayOptions): AsyncGenerator<string, void, unknown> {
+  const { userContent, systemMessages, sessionKey, gatewayAuth, log } = options;
+  const gatewayUrl = getGatewayUrl();
+
+  const messages = [...systemMessages, { role: 'user', content: userContent }];
 
   log?.info?.(`[DingTalk][Gateway] POST ${gatewayUrl}, session=${sessionKey}, messages=${messages.length}`);
 
   const response = await fetch(gatewayUrl, {
     method: 'POST',
-    headers,
+    headers: getGatewayHeaders(gatewayAuth),
     body: JSON.stringify({
       model: 'default',
       messages,
@@ -1130,13 +1267,19 @@ async function* streamFromGateway(options: GatewayOptions): AsyncGenerator<strin
     if (done) break;
 
     buffer += decoder.decode(value, { stream: true });
-    const lines = buffer.split('\n');
-    buffer = lines.pop() || '';
 
-    for (const line of lines) {
-      if (!line.startsWith('data: ')) continue;
-      const data = line.slice(6).trim();
-      if (data === '[DONE]') return;
+    // 原地按行扫描：不为整段 buffer 生成行数组，空行和 ": " 心跳行不产生任何子串
+    let lineStart = 0;
+    let newline: number;
+    while ((newline = buffer.indexOf('\n', lineStart)) !== -1) {
+      const start = lineStart;
+      lineStart = newline + 1;
+      // 空行和短心跳行直接按长度跳过
+      if (newline - start < SSE_DATA_PREFIX_LEN || !buffer.startsWith(SSE_DATA_PREFIX, start)) continue;
+      const data = buffer.slice(start + SSE_DATA_PREFIX_LEN, newline).trim();
+      if (data === SSE_DONE) return;
+      // 不含 content 字段的事件（role / finish_reason / usage 等）无需 JSON.parse
+      if (!data.includes('"content"')) continue;
 
       try {
         const chunk = JSON.parse(data);
@@ -1144,6 +1287,9 @@ async function* streamFromGateway(options: GatewayOptions): AsyncGenerator<strin
         if (content) yield content;
       } catch {}
     }
+    if (lineStart > 0) {
+      buffer = buffer.slice(lineStart);
+    }
   }
 }
 
@@ -2020,25 +2166,20 @@ async function handleDingTalkMessage(params: {
   // Gateway 认证：优先使用 token，其次 password
   const gatewayAuth = dingtalkConfig.gatewayToken || dingtalkConfig.gatewayPassword || '';
 
-  // 构建 system prompts & 获取 oapi token（用于图片和文件后处理）
-  const systemPrompts: string[] = [];
-  let oapiToken: string | null = null;
+  // system prompts（按配置缓存）& 获取 oapi token（用于图片和文件后处理）
+  const systemMessages = getSystemMessages(dingtalkConfig);
+  let oapiTokenPromise: Promise<string | null> = Promise.resolve(null);
 
   if (dingtalkConfig.enableMediaUpload !== false) {
-    // 添加图片和文件使用提示（告诉 LLM 直接输出本地路径或文件标记）
-    systemPrompts.push(buildMediaSystemPrompt());
-    // 获取 token 用于后处理上传
-    oapiToken = await getOapiAccessToken(dingtalkConfig);
-    log?.info?.(`[DingTalk][Media] oapiToken 获取${oapiToken ? '成功' : '失败'}`);
+    // token 仅用于后处理上传：与 AI Card 创建、Gateway 流式并行获取，不阻塞首字响应
+    oapiTokenPromise = getOapiAccessToken(dingtalkConfig).then((token) => {
+      log?.info?.(`[DingTalk][Media] oapiToken 获取${token ? '成功' : '失败'}`);
+      return token;
+    });
   } else {
     log?.info?.(`[DingTalk][Media] enableMediaUpload=false，跳过`);
   }
 
-  // 自定义 system prompt
-  if (dingtalkConfig.systemPrompt) {
-    systemPrompts.push(dingtalkConfig.systemPrompt);
-  }
-
   // 尝试创建 AI Card
   const card = await createAICard(dingtalkConfig, data, log);
 
@@ -2050,12 +2191,13 @@ async function handleDingTalkMessage(params: {
     let lastUpdateTime = 0;
     const updateInterval = 300; // 最小更新间隔 ms
     let chunkCount = 0;
+    const streamer = createAICardStreamer(card, log);
 
     try {
       log?.info?.(`[DingTalk] 开始请求 Gateway 流式接口...`);
       for await (const chunk of streamFromGateway({
         userContent: content.text,
-        systemPrompts,
+        systemMessages,
         sessionKey,
         gatewayAuth,
         log,
@@ -2071,18 +2213,17 @@ async function handleDingTalkMessage(params: {
         const now = Date.now();
         if (now - lastUpdateTime >= updateInterval) {
           // 实时清理文件、视频、音频标记（避免用户在流式过程中看到标记）
-          const displayContent = accumulated
-            .replace(FILE_MARKER_PATTERN, '')
-            .replace(VIDEO_MARKER_PATTERN, '')
-            .replace(AUDIO_MARKER_PATTERN, '')
-            .trim();
-          await streamAICard(card, displayContent, false, log);
+          const displayContent = accumulated.replace(MEDIA_MARKER_PATTERN, '').trim();
+          streamer.push(displayContent);
           lastUpdateTime = now;
         }
       }
+      await streamer.drain();
 
       log?.info?.(`[DingTalk] Gateway 流完成，共 ${chunkCount} chunks, ${accumulated.length} 字符`);
 
+      const oapiToken = await oapiTokenPromise;
+
       // 后处理01：上传本地图片到钉钉，替换 file:// 路径为 media_id
       log?.info?.(`[DingTalk][Media] 开始图片后处理，内容片段="${accumulated.slice(0, 200)}..."`);
       accumulated = await processLocalImages(accumulated, oapiToken, log);
@@ -2120,6 +2261,8 @@ async function handleDingTalkMessage(params: {
       log?.error?.(`[DingTalk] 错误详情: ${err.stack}`);
       accumulated += `\n\n⚠️ 响应中断: ${err.message}`;
       try {
+        // 等待在途的流式更新结束，避免与 finish 请求乱序
+        await streamer.drain().catch(() => {});
         await finishAICard(card, accumulated, log);
       } catch (finishErr: any) {
         log?.error?.(`[DingTalk] 错误恢复 finish 也失败: ${finishErr.message}`);
@@ -2134,7 +2277,7 @@ async function handleDingTalkMessage(params: {
     try {
       for await (const chunk of streamFromGateway({
         userContent: content.text,
-        systemPrompts,
+        systemMessages,
         sessionKey,
         gatewayAuth,
         log,
@@ -2142,6 +2285,8 @@ async function handleDingTalkMessage(params: {
         fullResponse += chunk;
       }
 
+      const oapiToken = await oapiTokenPromise;
+
       // 后处理01：上传本地图片到钉钉，替换 file:// 路径为 media_id
       log?.info?.(`[DingTalk][Media] (降级模式) 开始图片后处理，内容片段="${fullResponse.slice(0, 200)}..."`);
       fullResponse = await processLocalImages(fullResponse, oapiToken, log);
@@ -2382,12 +2527,16 @@ const dingtalkPlugin = {
       const { account, cfg, abortSignal } = ctx;
       const config = account.config;
 
-      if (!config.clientId || !config.clientSecret) {
-        throw new Error('DingTalk clientId and clientSecret are required');
+      // 一次性列出所有缺失的必填项，避免逐个修复、逐次重启
+      const missing = ['clientId', 'clientSecret'].filter((key) => !config[key]);
+      if (missing.length > 0) {
+        throw new Error(`DingTalk ${missing.join(' and ')} ${missing.length > 1 ? 'are' : 'is'} required`);
       }
 
       ctx.log?.info(`[${account.accountId}] 启动钉钉 Stream 客户端...`);
 
+      // Stream SDK 仅在启动账号时按需加载，注册插件、probe、主动发送等路径不需要它
+      const { DWClient, TOPIC_ROBOT } = await import('dingtalk-stream');
       const client = new DWClient({
         clientId: config.clientId,
         clientSecret: config.clientSecret,
@@ -2442,11 +2591,22 @@ const dingtalkPlugin = {
       rt.channel.activity.record('dingtalk-connector', account.accountId, 'start');
 
       let stopped = false;
+
+      // 断开 Stream 长连接，停止后不再占用 socket 和重连定时器
+      const disconnectClient = () => {
+        try {
+          client.disconnect();
+        } catch (err: any) {
+          ctx.log?.warn?.(`[${account.accountId}] 断开钉钉 Stream 客户端失败: ${err.message}`);
+        }
+      };
+
       if (abortSignal) {
         abortSignal.addEventListener('abort', () => {
           if (stopped) return;
           stopped = true;
           ctx.log?.info(`[${account.accountId}] 停止钉钉 Stream 客户端...`);
+          disconnectClient();
           rt.channel.activity.record('dingtalk-connector', account.accountId, 'stop');
         });
       }
@@ -2455,6 +2615,7 @@ const dingtalkPlugin = {
         stop: () => {
           if (stopped) return;
           stopped = true;
+          disconnectClient();
           ctx.log?.info(`[${account.accountId}] 钉钉 Channel 已停止`);
           rt.channel.activity.record('dingtalk-connector', account.accountId, 'stop');
         },